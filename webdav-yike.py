@@ -2,6 +2,9 @@
 
 
 import sys, os
+import time
+
+START_TIME = time.time()
 
 
 # sys.path.append(os.environ["PYLIB"])
@@ -11,21 +14,11 @@ import sys, os
 # LogConfig.set_logtoScreen("debug")
 
 
-from pybaiduphoto import API
-
-
+# heavy modules (pybaiduphoto, browser_cookie3, wsgidav, ...) are imported
+# only in the mode which needs them, to keep the startup fast.
 import logging
 import argparse
 import json
-import browser_cookie3
-import requests
-
-
-from wsgidav import wsgidav_app
-from wsgidav.wsgidav_app import WsgiDAVApp
-from wsgidav.default_conf import DEFAULT_CONFIG
-from cheroot import wsgi
-from yikeProvider import baiduphoto as Provider
 
 
 sysConfig_default = {
@@ -38,22 +31,60 @@ sysConfig_default = {
     "ITEM_NUM_MAX_IN_LOCATION": 999,
     "ITEM_NUM_MAX_IN_THING": 999,
     "DELIMITER": "@",
+    "WARMUP_ON_START": True,
+    "API_INIT_TIMEOUT": 60,  # seconds a request waits for the API to be ready
+    "SYNC_INTERVAL": 10,  # seconds a dir listing is served from cache
+    "FULL_SYNC_INTERVAL": 600,  # seconds between full relistings of a dir
+    "HASH_INDEX_FILE": "hashIndex.json",  # content hash -> item, "" to disable
+    "HASH_INDEX_SAVE_INTERVAL": 60,  # seconds, also saved at shutdown
+    "CACHE_MEMORY_MAX_MB": 512,  # memory budget of the dir cache, <=0 no limit
+    "CONTENT_CACHE_DIR": "",  # "" means <tmp>/webdav-yike
+    "CONTENT_CACHE_MAX_MB": 1024,  # file contents on local disk, <=0 disables
+    "PREFETCH_NUM": 4,  # items read ahead when a dir is downloaded in order
+    "PREFETCH_WORKERS": 2,
+    # admission control of upstream requests, downloads and listings each
+    "UPSTREAM_MAX_TOTAL": 8,
+    "UPSTREAM_MAX_PER_USER": 3,
+    "UPSTREAM_MAX_QUEUE_PER_USER": 4,
+    "UPSTREAM_QUEUE_TIMEOUT": 30,  # seconds, then 503
+    "UPSTREAM_RETRY_AFTER": 5,  # seconds, Retry-After of 503
+    "SERVER_THREADS": 32,
+    "THUMBNAIL_DIR_NAME": "",  # e.g. ".thumbs", "" disables the thumbnail view
+    "THUMBNAIL_CACHE_MAX_MB": 256,  # thumbnails on local disk, <=0 disables
+    "THUMBNAIL_SIZE": "",  # e.g. "c200_u200", "" keeps the size of the url
 }
 
 
 def dumpCookies(cj, filePath):
-    cookies = requests.utils.dict_from_cookiejar(cj)
+    import requests
+
     with open(filePath, "w") as f:
         d = requests.utils.dict_from_cookiejar(cj)
         f.write(json.dumps(d))
 
 
 def loadCookies(filePath):
+    import requests
+
     with open(filePath, "r") as f:
         d = json.loads(f.read())
     return requests.utils.cookiejar_from_dict(d)
 
 
+def createAPI(cjFile, proxies):
+    # slow: imports pybaiduphoto and sets up the session, run in background
+    from pybaiduphoto import API
+
+    cj = loadCookies(cjFile)
+    api = API(cookies=cj, proxies=proxies)
+    try:
+        api.req.get_bdstoken_Cache()
+    except Exception as e:
+        # not fatal, bdstoken will be requested again with the first request
+        logging.warning("cannot get bdstoken in advance: {}".format(e))
+    return api
+
+
 class ParseKwargs(argparse.Action):
     # https://sumit-ghosh.com/articles/parsing-dictionary-key-value-pairs-kwargs-argparse-python/
     def __call__(self, parser, namespace, values, option_string=None):
@@ -111,6 +142,8 @@ logging.debug("args input:=" + str(args))
 
 
 if args["configcookies"] is not None:
+    import browser_cookie3
+
     browser = args["configcookies"].lower()
     if hasattr(browser_cookie3, browser):
         func = getattr(browser_cookie3, browser)
@@ -139,30 +172,47 @@ if len(args["cjfile"]) == 0:
     exit()
 else:
     cjFile = args["cjfile"][0]
-    cj = loadCookies(cjFile)
+    if not os.path.isfile(cjFile):
+        logging.error("cjfile [{}] not found".format(cjFile))
+        exit()
 
     if args["proxy"] is not None:
         proxies = {"https": args["proxy"]}
     else:
         proxies = None
 
-    api = API(cookies=cj, proxies=proxies)
-
 
 sysConfig = dict(sysConfig_default)
 if args["option"] is not None:
     for k in args["option"]:
         if k in sysConfig:
             TYPE = type(sysConfig[k])
-            sysConfig[k] = TYPE(args["option"][k])
+            if TYPE is bool:
+                sysConfig[k] = args["option"][k].lower() in ["true", "1", "yes"]
+            else:
+                sysConfig[k] = TYPE(args["option"][k])
 
 
+from wsgidav import util, wsgidav_app
+from wsgidav.wsgidav_app import WsgiDAVApp
+from cheroot import wsgi
+from yikeProvider import baiduphoto as Provider
+from yikeProvider import AdmissionMiddleware
+
+provider = Provider(sysConfig)
+
 config = wsgidav_app.DEFAULT_CONFIG.copy()
+middleware_stack = list(config["middleware_stack"])
+middleware_stack.insert(
+    [mw.__name__ for mw in middleware_stack].index("HTTPAuthenticator") + 1,
+    AdmissionMiddleware,
+)
 config.update(
     {
         "host": "0.0.0.0",
         "port": args["port"],
-        "provider_mapping": {"/": Provider(sysConfig, api)},
+        "provider_mapping": {"/": provider},
+        "middleware_stack": middleware_stack,
         "simple_dc": {
             "user_mapping": user_mapping,
         },
@@ -178,11 +228,24 @@ config.update(
 )
 
 
+util.init_logging(config)
+_logger = util.get_module_logger("webdav-yike")
 app = WsgiDAVApp(config)
 
 server_args = {
     "bind_addr": (config["host"], config["port"]),
     "wsgi_app": app,
+    "numthreads": sysConfig["SERVER_THREADS"],
 }
 server = wsgi.Server(**server_args)
-server.start()
+server.prepare()  # bind the port before the API is ready
+_logger.info(
+    "listening on {}:{} after {:.3f}s".format(
+        config["host"], config["port"], time.time() - START_TIME
+    )
+)
+provider.initInBackground(lambda: createAPI(cjFile=cjFile, proxies=proxies))
+try:
+    server.serve()
+finally:
+    provider.close()
@@ -8,14 +8,25 @@ import time
 import tempfile
 import logging
 import random
+import threading
+import hashlib
+import json
+import itertools
+import contextlib
+import re
 from abc import abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import sys, os, io
 
 
 from wsgidav import util
 from wsgidav.dav_error import (
+    HTTP_BAD_GATEWAY,
     HTTP_FORBIDDEN,
+    HTTP_NOT_FOUND,
+    HTTP_SERVICE_UNAVAILABLE,
     DAVError,
     PRECONDITION_CODE_ProtectedProperty,
 )
@@ -26,12 +37,19 @@ from wsgidav.dav_provider import (
     DAVNonCollection,
 )
 from wsgidav.stream_tools import StreamingFile, FileLikeQueue
-
+from wsgidav.mw.base_mw import BaseMiddleware
 
 __docformat__ = "reStructuredText"
 
 _logger = util.get_module_logger(__name__)
 
+# user (or client address) of the request handled by the current thread
+_requestContext = threading.local()
+
+
+def getCurrentUser():
+    return getattr(_requestContext, "user", "")
+
 
 def pathjoin(path1, path2):
     if path1[-1] == "/":
@@ -41,77 +59,602 @@ def pathjoin(path1, path2):
     return path1 + "/" + path2
 
 
+def estimateSize(obj):
+    # rough number of bytes held by obj
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(
+            estimateSize(k) + estimateSize(v) for k, v in obj.items()
+        )
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimateSize(v) for v in obj)
+    if hasattr(obj, "__slots__"):
+        return sys.getsizeof(obj) + sum(
+            estimateSize(getattr(obj, k)) for k in obj.__slots__
+        )
+    return sys.getsizeof(obj)
+
+
 class NoSQL:
-    def __init__(self):
+    # Thread safe. Writes to a table hold one of LOCK_STRIPES locks chosen by
+    # the table name, so writers to different tables rarely wait for each
+    # other. Reads take no lock. replaceTable swaps a whole table at once.
+    #
+    # Values of the tables for which isRefTable(table) is True are held by
+    # other tables too, only the reference to them is counted in the size.
+    LOCK_STRIPES = 64
+    REF_SIZE = 8
+
+    def __init__(self, isRefTable=None):
         # NoSQL 类型, in each table,
+        self.isRefTable = isRefTable
         self.tables = {}
+        self.tableSizes = {}  # estimated bytes of each table
+        self.totalSize = 0
+        self.locks = [threading.RLock() for _ in range(self.LOCK_STRIPES)]
+        self.sizeLock = threading.Lock()
+
+    def getLock(self, table):
+        return self.locks[hash(table) % self.LOCK_STRIPES]
 
     def isTableExist(self, table):
         return table in self.tables
 
     def createTableIfNotExist(self, table):
-        if table not in self.tables:
-            self.tables[table] = {}
+        with self.getLock(table):
+            if table not in self.tables:
+                self.tableSizes[table] = 0
+                self.tables[table] = {}
 
     def dropTableIfExist(self, table):
-        if self.isTableExist(table):
+        with self.getLock(table):
+            if table not in self.tables:
+                return
             del self.tables[table]
+            size = self.tableSizes.pop(table)
+        with self.sizeLock:
+            self.totalSize -= size
+
+    def getEntrySize(self, table, key, value):
+        if self.isRefTable is not None and self.isRefTable(table):
+            return estimateSize(key) + self.REF_SIZE
+        return estimateSize(key) + estimateSize(value)
+
+    def replaceTable(self, table, values):
+        # values: the new {key: value}, not to be modified by the caller
+        size = sum(self.getEntrySize(table, k, v) for k, v in values.items())
+        with self.getLock(table):
+            oldSize = self.tableSizes.get(table, 0)
+            self.tables[table] = values
+            self.tableSizes[table] = size
+        with self.sizeLock:
+            self.totalSize += size - oldSize
 
     def deleteItemIfExist(self, table, key):
-        del self.tables[table][key]
+        with self.getLock(table):
+            values = self.tables.get(table, None)
+            if values is None or key not in values:
+                return
+            value = values.pop(key)
+            self._addSize(table, -self.getEntrySize(table, key, value))
 
     def setValue(self, table, key, value):  # overwrite
-        self.tables[table][key] = value
+        size = self.getEntrySize(table, key, value)
+        with self.getLock(table):
+            values = self.tables[table]
+            if key in values:
+                size -= self.getEntrySize(table, key, values[key])
+            values[key] = value
+            self._addSize(table, size)
 
     def setValueIfKeyNotExist(self, table, key, value):
-        if key not in self.tables[table]:
-            self.tables[table][key] = value
+        with self.getLock(table):
+            if key not in self.tables[table]:
+                self.setValue(table=table, key=key, value=value)
+
+    def _addSize(self, table, size):
+        # the lock of table is held by the caller
+        self.tableSizes[table] += size
+        with self.sizeLock:
+            self.totalSize += size
+
+    def getTableSize(self, table):
+        return self.tableSizes.get(table, 0)
+
+    def getTableSizes(self):
+        return dict(self.tableSizes)
+
+    def getTotalSize(self):
+        return self.totalSize
+
+    def getTable(self, table):
+        # current {key: value} of table or None, for reading only
+        return self.tables.get(table, None)
 
     def getValueElseNone(self, table, key):
-        return self.tables[table].get(key, None)
+        values = self.tables.get(table, None)
+        if values is None:
+            return None
+        return values.get(key, None)
+
+
+class UpstreamBusyError(DAVError):
+    def __init__(self, retryAfter):
+        super().__init__(HTTP_SERVICE_UNAVAILABLE, "too many upstream requests")
+        self.retryAfter = retryAfter
+
+
+class AdmissionControl:
+    # At most maxTotal upstream requests at once, and at most maxPerUser of
+    # them for one user (<=0 means no limit). Up to maxQueuePerUser further
+    # requests of a user wait, at most timeout seconds; more are refused at
+    # once with UpstreamBusyError (503 + Retry-After, see AdmissionMiddleware).
+    def __init__(self, maxTotal, maxPerUser, maxQueuePerUser, timeout, retryAfter):
+        self.maxTotal = maxTotal
+        self.maxPerUser = maxPerUser
+        self.maxQueuePerUser = maxQueuePerUser
+        self.timeout = timeout
+        self.retryAfter = retryAfter
+        self.running = 0
+        self.runningByUser = {}
+        self.waitingByUser = {}
+        self.cond = threading.Condition()
+
+    def canRun(self, user):
+        if self.maxTotal > 0 and self.running >= self.maxTotal:
+            return False
+        if self.maxPerUser > 0 and self.runningByUser.get(user, 0) >= self.maxPerUser:
+            return False
+        return True
+
+    def acquire(self, user, blocking=True):
+        # return False only if not blocking and there is no free slot
+        with self.cond:
+            if not self.canRun(user):
+                if not blocking:
+                    return False
+                if self.waitingByUser.get(user, 0) >= self.maxQueuePerUser:
+                    raise UpstreamBusyError(retryAfter=self.retryAfter)
+                self.waitingByUser[user] = self.waitingByUser.get(user, 0) + 1
+                try:
+                    isFree = self.cond.wait_for(
+                        lambda: self.canRun(user), timeout=self.timeout
+                    )
+                finally:
+                    self.waitingByUser[user] -= 1
+                    if self.waitingByUser[user] == 0:
+                        del self.waitingByUser[user]
+                if not isFree:
+                    raise UpstreamBusyError(retryAfter=self.retryAfter)
+            self.running += 1
+            self.runningByUser[user] = self.runningByUser.get(user, 0) + 1
+            return True
+
+    def release(self, user):
+        with self.cond:
+            self.running -= 1
+            self.runningByUser[user] -= 1
+            if self.runningByUser[user] == 0:
+                del self.runningByUser[user]
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, user=None):
+        # user=None: the user of the current request
+        user = getCurrentUser() if user is None else user
+        self.acquire(user)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    # Put it after HTTPAuthenticator in the middleware_stack. It records the
+    # user of the request for AdmissionControl and turns UpstreamBusyError
+    # into a fast 503 with Retry-After.
+    def __call__(self, environ, start_response):
+        _requestContext.user = environ.get("wsgidav.auth.user_name") or environ.get(
+            "REMOTE_ADDR", ""
+        )
+        sub_app_start_response = util.SubAppStartResponse()
+        response_started = False
+        try:
+            app_iter = self.next_app(environ, sub_app_start_response)
+            for v in app_iter:
+                if not response_started:
+                    start_response(
+                        sub_app_start_response.status,
+                        sub_app_start_response.response_headers,
+                        sub_app_start_response.exc_info,
+                    )
+                response_started = True
+                yield v
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            if not response_started:
+                start_response(
+                    sub_app_start_response.status,
+                    sub_app_start_response.response_headers,
+                    sub_app_start_response.exc_info,
+                )
+        except UpstreamBusyError as e:
+            if response_started:
+                raise
+            body = b"Too many upstream requests, retry later."
+            start_response(
+                "503 Service Unavailable",
+                [
+                    ("Content-Type", "text/plain"),
+                    ("Content-Length", str(len(body))),
+                    ("Retry-After", str(e.retryAfter)),
+                    ("Date", util.get_rfc1123_time()),
+                ],
+            )
+            yield body
+
+
+class ItemRecord:
+    # Compact item info kept in PathCache instead of the upstream info dict.
+    # Same getters as the API item; toApiObj rebuilds the API item for the
+    # operations which request upstream (download, delete).
+    __slots__ = ("ID", "name", "size", "ctime", "mtime", "category")
+
+    def __init__(self, ID, name, size, ctime, mtime, category=None):
+        self.ID = ID
+        self.name = name
+        self.size = size
+        self.ctime = ctime
+        self.mtime = mtime
+        self.category = category
+
+    @classmethod
+    def fromInfo(cls, info):
+        return cls(
+            ID=str(info["fsid"] if "fsid" in info else info["fs_id"]),
+            name=info["path"].split("/")[-1],
+            size=info.get("size", 0),
+            ctime=info.get("ctime", 0),
+            mtime=info.get("mtime", 0),
+            category=info.get("category", None),
+        )
+
+    @classmethod
+    def fromApiObj(cls, item):
+        if isinstance(item, cls):
+            return item
+        return cls.fromInfo(item.getInfo())
+
+    def getInfo(self):
+        # the fields of the upstream info dict which are kept
+        info = {
+            "fsid": self.ID,
+            "path": "/" + self.name,
+            "size": self.size,
+            "ctime": self.ctime,
+            "mtime": self.mtime,
+        }
+        if self.category is not None:
+            info["category"] = self.category
+        return info
+
+    def toApiObj(self, api):
+        return api.getOnlineItem_ByInfo(info=self.getInfo())
+
+    def getID(self):
+        return self.ID
+
+    def getName(self):
+        return self.name
+
+    def getSize(self):
+        return self.size
+
+    def getCreationDate(self):
+        return self.ctime
+
+    def getModificationDate(self):
+        return self.mtime
 
 
 class PathCache:
     # 测试发现文件名自动保持唯一，可作为唯一标识符
+    #
+    # Item lists (<DirType>_list_<ID>) hold the ItemRecords of their items,
+    # so a cached list is always complete. The Item table only indexes the
+    # records by ID and the month lists of ByDate share the records of the
+    # Item_list_ByDate list, both are counted as references.
+    # Entries are evicted in LRU order once the estimated size exceeds
+    # maxMemory (bytes, <=0 means no limit); lists pinned by pinList are kept.
+    #
+    # The LRU order is split into LRU_SHARDS shards with a lock each. Entries
+    # carry a global sequence number, eviction picks the shard whose oldest
+    # entry is the oldest overall.
+    LRU_SHARDS = 16
 
-    def __init__(self, AlbumTypes):
-        self.nosql = NoSQL()
+    def __init__(self, AlbumTypes, maxMemory=0):
+        self.nosql = NoSQL(isRefTable=self.isRefTable)
         # self.AlbumTypes = AlbumTypes
+        self.maxMemory = maxMemory
+        # (table, key or None) -> (seq, item name), oldest first
+        self.lruShards = [OrderedDict() for _ in range(self.LRU_SHARDS)]
+        self.lruLocks = [threading.Lock() for _ in range(self.LRU_SHARDS)]
+        self.lruSeq = itertools.count()  # next() is atomic
+        self.evictLock = threading.Lock()
+        self.pins = {}  # (DirType, ID or None) -> count
+        self.pinLock = threading.Lock()
+        # one lock of each per list table, created on first use: the sync lock
+        # is held while a list is synced (paging upstream), the list lock only
+        # while the cached list is written
+        self.syncLocks = {}
+        self.listLocks = {}
+        self.lockTableLock = threading.Lock()
 
         DirTypes = AlbumTypes
         self.nosql.createTableIfNotExist(table="Item")
         self.nosql.createTableIfNotExist(table="itemNameToID")
+        self.nosql.createTableIfNotExist(table="SyncState")
+        self.nosql.createTableIfNotExist(table="DateTree")
+        self.nosql.createTableIfNotExist(table="ThumbURL")
         for Dir in DirTypes:
             self.nosql.createTableIfNotExist(table=Dir)  # store info
             # self.nosql.createTableIfNotExists(table = Dir+"_list" ) #
 
-    def cacheItem(self, item):
-        self.cache_apiObj(TypeMarker="Item", apiObj=item)
-        self.nosql.setValue(
-            table="itemNameToID", key=item.getName(), value=item.getID()
+    @staticmethod
+    def isRefTable(table):
+        return table == "Item" or table.startswith("ByDate_list_")
+
+    def getLRUShard(self, lruKey):
+        i = hash(lruKey) % self.LRU_SHARDS
+        return self.lruLocks[i], self.lruShards[i]
+
+    def touch(self, table, key=None, name=None):
+        # mark as most recently used, key=None means the whole (list) table
+        lruKey = (table, key)
+        lock, shard = self.getLRUShard(lruKey)
+        seq = next(self.lruSeq)
+        with lock:
+            if lruKey in shard:
+                shard.move_to_end(lruKey)
+                if name is None:
+                    name = shard[lruKey][1]
+            shard[lruKey] = (seq, name)
+
+    def untouch(self, table, key=None):
+        lruKey = (table, key)
+        lock, shard = self.getLRUShard(lruKey)
+        with lock:
+            shard.pop(lruKey, None)
+
+    def getLockOf(self, locks, DirType, ID):
+        # the month lists of ByDate share the locks of Item_list_ByDate
+        if DirType == "ByDate":
+            DirType, ID = "Item", "ByDate"
+        table = DirType + "_list_" + ID
+        with self.lockTableLock:
+            lock = locks.get(table, None)
+            if lock is None:
+                lock = locks[table] = threading.RLock()
+            return lock
+
+    def getSyncLock(self, DirType, ID):
+        return self.getLockOf(self.syncLocks, DirType=DirType, ID=ID)
+
+    def getListLock(self, DirType, ID):
+        return self.getLockOf(self.listLocks, DirType=DirType, ID=ID)
+
+    @contextlib.contextmanager
+    def pinList(self, DirType, ID=None):
+        # the list is not evicted meanwhile, ID=None pins all lists of DirType
+        pin = (DirType, ID)
+        with self.pinLock:
+            self.pins[pin] = self.pins.get(pin, 0) + 1
+        try:
+            yield
+        finally:
+            with self.pinLock:
+                self.pins[pin] -= 1
+                if self.pins[pin] == 0:
+                    del self.pins[pin]
+
+    def isPinned(self, table):
+        DirType, _, ID = table.partition("_list_")
+        with self.pinLock:
+            return (DirType, ID) in self.pins or (DirType, None) in self.pins
+
+    def evictIfNeeded(self):
+        if self.maxMemory <= 0 or self.nosql.getTotalSize() <= self.maxMemory:
+            return
+        if not self.evictLock.acquire(blocking=False):
+            return  # another thread is evicting
+        skipped = []  # pinned lists, put back afterwards
+        try:
+            while self.nosql.getTotalSize() > self.maxMemory:
+                oldest = None  # (seq, shard index)
+                for i, (lock, shard) in enumerate(zip(self.lruLocks, self.lruShards)):
+                    with lock:
+                        if len(shard) > 0:
+                            seq = next(iter(shard.values()))[0]
+                            if oldest is None or seq < oldest[0]:
+                                oldest = (seq, i)
+                if oldest is None:
+                    break
+                with self.lruLocks[oldest[1]]:
+                    shard = self.lruShards[oldest[1]]
+                    if len(shard) == 0:
+                        continue
+                    lruKey, value = shard.popitem(last=False)
+                if lruKey[1] is None and self.isPinned(lruKey[0]):
+                    skipped.append((lruKey, value))
+                    continue
+                self.evict(lruKey=lruKey, name=value[1])
+        finally:
+            for lruKey, value in reversed(skipped):
+                lock, shard = self.getLRUShard(lruKey)
+                with lock:
+                    if lruKey not in shard:
+                        shard[lruKey] = value
+                        shard.move_to_end(lruKey, last=False)
+            self.evictLock.release()
+        logging.debug(
+            "cache size {} bytes after eviction, Item table {} bytes".format(
+                self.nosql.getTotalSize(), self.nosql.getTableSize("Item")
+            )
         )
 
-    def appendItemIntoAAlbum(self, DirType, ID, itemID, checkTableExist=True):
-        table = DirType + "_list_" + ID
-        if checkTableExist:
-            if not self.nosql.isTableExist(table):
-                self.nosql.createTableIfNotExist(table)
-                self.nosql.setValue(table=table, key="0", value="0")
-        Len = int(self.nosql.getValueElseNone(table=table, key="0"))
-        self.nosql.setValue(table=table, key=str(Len + 1), value=itemID)
-        self.nosql.setValue(table=table, key="0", value=str(Len + 1))
-
-    def getItemListInAAlbum(self, DirType, ID):
+    def evict(self, lruKey, name):
+        table, key = lruKey
+        if key is None:
+            self.nosql.dropTableIfExist(table=table)
+            self.nosql.deleteItemIfExist(table="SyncState", key=table)
+            if table == "Item_list_ByDate":
+                self.dropDateBuckets()  # they share its records
+            elif table.startswith("ByDate_list_"):
+                self.nosql.setValue(table="DateTree", key="syncTime", value=None)
+        else:
+            self.nosql.deleteItemIfExist(table=table, key=key)
+            if name is not None:
+                self.nosql.deleteItemIfExist(table="itemNameToID", key=name)
+
+    def getMemoryUsage(self):
+        # {table: estimated bytes}
+        return self.nosql.getTableSizes()
+
+    def cacheItem(self, item, overwrite=False):
+        # return the cached ItemRecord
+        record = ItemRecord.fromApiObj(item)
+        if overwrite:
+            self.nosql.setValue(table="Item", key=record.ID, value=record)
+        else:
+            with self.nosql.getLock("Item"):
+                old = self.nosql.getValueElseNone(table="Item", key=record.ID)
+                if old is None:
+                    self.nosql.setValue(table="Item", key=record.ID, value=record)
+                else:
+                    record = old
+        self.nosql.setValue(table="itemNameToID", key=record.name, value=record.ID)
+        self.touch(table="Item", key=record.ID, name=record.name)
+        self.evictIfNeeded()
+        return record
+
+    def deleteItemIfExist(self, itemID, name=None):
+        self.nosql.deleteItemIfExist(table="Item", key=itemID)
+        self.untouch(table="Item", key=itemID)
+        if name is not None:
+            self.nosql.deleteItemIfExist(table="itemNameToID", key=name)
+
+    def appendItemIntoAAlbum(self, DirType, ID, item, checkTableExist=True):
+        # atomic, the item is written before the length "0". Waits for a sync
+        # of the list, which would replace it without the item otherwise.
         table = DirType + "_list_" + ID
-        if self.nosql.isTableExist(table):
+        record = ItemRecord.fromApiObj(item)
+        with self.getListLock(DirType=DirType, ID=ID), self.nosql.getLock(table):
+            if checkTableExist:
+                if not self.nosql.isTableExist(table):
+                    self.nosql.createTableIfNotExist(table)
+                    self.nosql.setValue(table=table, key="0", value="0")
             Len = int(self.nosql.getValueElseNone(table=table, key="0"))
-            return [
-                self.nosql.getValueElseNone(table=table, key=str(i))
-                for i in range(1, Len + 1)
-            ]
+            self.nosql.setValue(table=table, key=str(Len + 1), value=record)
+            self.nosql.setValue(table=table, key="0", value=str(Len + 1))
+        self.touch(table=table)
+        self.evictIfNeeded()
+
+    def getItemRecordsInAAlbum(self, DirType, ID):
+        # no lock: the table is read from one snapshot of its dict
+        table = DirType + "_list_" + ID
+        values = self.nosql.getTable(table)
+        if values is not None:
+            self.touch(table=table)
+            Len = int(values["0"])
+            return [values[str(i)] for i in range(1, Len + 1)]
         else:
             return None
 
+    def setItemListInAAlbum(self, DirType, ID, items):
+        # replace the whole list at once
+        table = DirType + "_list_" + ID
+        values = {
+            str(i + 1): ItemRecord.fromApiObj(item) for i, item in enumerate(items)
+        }
+        values["0"] = str(len(items))
+        self.nosql.replaceTable(table=table, values=values)
+        self.touch(table=table)
+        self.evictIfNeeded()
+
+    def removeItemFromAAlbum(self, DirType, ID, itemID):
+        # waits for a sync of the list, like appendItemIntoAAlbum
+        with self.getListLock(DirType=DirType, ID=ID):
+            l = self.getItemRecordsInAAlbum(DirType=DirType, ID=ID)
+            if l is not None and any(r.getID() == itemID for r in l):
+                self.setItemListInAAlbum(
+                    DirType=DirType, ID=ID, items=[r for r in l if r.getID() != itemID]
+                )
+
+    def setDateBuckets(self, buckets, syncTime, isComplete=True):
+        # buckets: {"2022-08": [ItemRecord, ...]}, one list table per month.
+        # Not complete: only the months in buckets change, [] drops a month.
+        months = set(self.getDateMonths())
+        if isComplete:
+            buckets = dict({m: [] for m in months}, **buckets)
+        for month, records in buckets.items():
+            if len(records) > 0:
+                self.setItemListInAAlbum(DirType="ByDate", ID=month, items=records)
+                months.add(month)
+            else:
+                self.nosql.dropTableIfExist(table="ByDate_list_" + month)
+                self.untouch(table="ByDate_list_" + month)
+                months.discard(month)
+        self.nosql.setValue(
+            table="DateTree", key="months", value=sorted(months, reverse=True)
+        )
+        self.nosql.setValue(table="DateTree", key="syncTime", value=syncTime)
+
+    def dropDateBuckets(self):
+        for month in self.getDateMonths():
+            self.nosql.dropTableIfExist(table="ByDate_list_" + month)
+            self.untouch(table="ByDate_list_" + month)
+        self.nosql.setValue(table="DateTree", key="months", value=[])
+        self.nosql.setValue(table="DateTree", key="syncTime", value=None)
+
+    def getDateTreeSyncTime(self):
+        return self.nosql.getValueElseNone(table="DateTree", key="syncTime")
+
+    def getDateMonths(self):
+        months = self.nosql.getValueElseNone(table="DateTree", key="months")
+        return [] if months is None else months
+
+    def getSyncState(self, DirType, ID):
+        # {"watermark": max mtime seen, "syncTime": ..., "fullSyncTime": ...}
+        return self.nosql.getValueElseNone(
+            table="SyncState", key=DirType + "_list_" + ID
+        )
+
+    def setSyncState(self, DirType, ID, state):
+        self.nosql.setValue(table="SyncState", key=DirType + "_list_" + ID, value=state)
+
+    def deleteSyncState(self, DirType, ID):
+        # the next sync of the list is a full one
+        self.nosql.deleteItemIfExist(table="SyncState", key=DirType + "_list_" + ID)
+
+    def expireFullSync(self, DirType, ID):
+        # like deleteSyncState, but the cached list is still served meanwhile
+        state = self.getSyncState(DirType=DirType, ID=ID)
+        if state is not None:
+            self.setSyncState(DirType=DirType, ID=ID, state=dict(state, fullSyncTime=0))
+
+    def setThumbURL(self, itemID, url, DirType, ID):
+        # the list (DirType, ID) is the one which returned the url
+        self.nosql.setValue(table="ThumbURL", key=itemID, value=(url, DirType, ID))
+        self.touch(table="ThumbURL", key=itemID)
+        self.evictIfNeeded()
+
+    def getThumbURL(self, itemID):
+        # (url, (DirType, ID)) or None
+        value = self.nosql.getValueElseNone(table="ThumbURL", key=itemID)
+        if value is None:
+            return None
+        self.touch(table="ThumbURL", key=itemID)
+        return value[0], (value[1], value[2])
+
     def cache_apiObj(self, TypeMarker, apiObj):
         table = TypeMarker
         self.nosql.setValueIfKeyNotExist(
@@ -122,8 +665,11 @@ class PathCache:
         table = TypeMarker
         return self.nosql.getValueElseNone(table=table, key=ID)
 
-    def getItemInfo(self, itemID):
-        return self.getapiObjInfo(TypeMarker="Item", ID=itemID)
+    def getItemRecord(self, itemID):
+        record = self.nosql.getValueElseNone(table="Item", key=itemID)
+        if record is not None:
+            self.touch(table="Item", key=itemID)
+        return record
 
     def getItemIDByName(self, name):
         table = "itemNameToID"
@@ -134,11 +680,273 @@ class PathCache:
         table2 = DirType + "_list_" + ID
         self.nosql.deleteItemIfExist(table=table1, key=ID)
         self.nosql.dropTableIfExist(table=table2)
+        self.nosql.deleteItemIfExist(table="SyncState", key=table2)
+        self.untouch(table=table2)
+
+
+class HashIndex:
+    # content (md5, size) -> item info, kept in a json file across restarts.
+    # Only hashes computed here (upload / download) are recorded.
+    # load and save are called in the background, changes only mark it dirty.
+    INFO_KEYS = ["fsid", "path", "size", "ctime", "mtime"]
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.table = {}
+        self.isDirty = False
+        self.lock = threading.Lock()
+        self.saveLock = threading.Lock()
+
+    def load(self):
+        # entries added before load take precedence over the file
+        if not self.filePath or not os.path.isfile(self.filePath):
+            return
+        try:
+            with open(self.filePath, "r") as f:
+                table = json.loads(f.read())
+        except Exception as e:
+            logging.warning("cannot load hash index {}: {}".format(self.filePath, e))
+            return
+        with self.lock:
+            table.update(self.table)
+            self.table = table
+
+    @staticmethod
+    def getKey(md5, size):
+        return "{}_{}".format(md5, size)
+
+    def get(self, md5, size):
+        with self.lock:
+            return self.table.get(self.getKey(md5, size), None)
+
+    def add(self, md5, size, item):
+        info = item.getInfo()
+        value = {k: info[k] for k in self.INFO_KEYS if k in info}
+        value["fsid"] = item.getID()
+        with self.lock:
+            self.table[self.getKey(md5, size)] = value
+            self.isDirty = True
+
+    def remove(self, md5, size):
+        with self.lock:
+            if self.table.pop(self.getKey(md5, size), None) is not None:
+                self.isDirty = True
+
+    def removeByID(self, itemID):
+        with self.lock:
+            keys = [k for k, v in self.table.items() if v["fsid"] == itemID]
+            for k in keys:
+                del self.table[k]
+            self.isDirty = self.isDirty or len(keys) > 0
+
+    def save(self):
+        # the file is written without holding the lock of the index
+        if not self.filePath:
+            return
+        with self.saveLock:
+            with self.lock:
+                if not self.isDirty:
+                    return
+                table = dict(self.table)
+                self.isDirty = False
+            tmpPath = self.filePath + ".tmp"
+            try:
+                with open(tmpPath, "w") as f:
+                    f.write(json.dumps(table))
+                os.replace(tmpPath, self.filePath)
+            except OSError as e:
+                logging.warning(
+                    "cannot save hash index {}: {}".format(self.filePath, e)
+                )
+                with self.lock:
+                    self.isDirty = True
+
+
+class ContentCache:
+    # file contents on local disk, LRU within maxSize bytes (<=0 disables).
+    # Files left by an earlier run are reused once load (in the background)
+    # has found them.
+    def __init__(self, dirPath, maxSize):
+        self.dirPath = dirPath
+        self.maxSize = maxSize
+        self.files = OrderedDict()  # key -> size, oldest first
+        self.totalSize = 0
+        self.lock = threading.Lock()
+        if maxSize > 0:
+            os.makedirs(dirPath, exist_ok=True)
+
+    def load(self):
+        # the files found are older than the ones put meanwhile
+        if self.maxSize <= 0:
+            return
+        found = OrderedDict()
+        paths = [os.path.join(self.dirPath, n) for n in os.listdir(self.dirPath)]
+        paths = [p for p in paths if os.path.isfile(p) and not p.endswith(".tmp")]
+        for p in sorted(paths, key=os.path.getmtime):
+            try:
+                found[os.path.basename(p)] = os.path.getsize(p)
+            except OSError:
+                pass
+        with self.lock:
+            for key in self.files:
+                found.pop(key, None)
+            found.update(self.files)
+            self.files = found
+            self.totalSize = sum(found.values())
+            self._evict()
+
+    def isEnabled(self):
+        return self.maxSize > 0
+
+    def getPath(self, key):
+        return os.path.join(self.dirPath, key)
+
+    def has(self, key):
+        with self.lock:
+            return key in self.files
+
+    def getSize(self, key):
+        # size of a cached file or None
+        with self.lock:
+            return self.files.get(key, None)
+
+    def open(self, key):
+        # return an opened file or None
+        with self.lock:
+            if key not in self.files:
+                return None
+            self.files.move_to_end(key)
+            try:
+                return open(self.getPath(key), "rb")
+            except OSError:
+                self.totalSize -= self.files.pop(key)
+                return None
+
+    def put(self, key, content):
+        if len(content) > self.maxSize:
+            return
+        # one temp file per writer, the same key may be put concurrently
+        fd, tmpPath = tempfile.mkstemp(dir=self.dirPath, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+        except BaseException:
+            os.remove(tmpPath)
+            raise
+        with self.lock:
+            os.replace(tmpPath, self.getPath(key))
+            self.totalSize -= self.files.pop(key, 0)
+            self.files[key] = len(content)
+            self.totalSize += len(content)
+            self._evict()
+
+    def _evict(self):
+        while self.totalSize > self.maxSize and len(self.files) > 0:
+            key, size = self.files.popitem(last=False)
+            self.totalSize -= size
+            try:
+                os.remove(self.getPath(key))
+            except OSError:
+                pass
+
+
+class Prefetcher:
+    # When the items of a listing are read one after another (GET of the
+    # item right after the last one read), the next num items are downloaded
+    # into the content cache by a small thread pool. Reads are followed per
+    # client and listing, for the MAX_READERS most recent ones.
+    MAX_READERS = 256
+
+    def __init__(self, provider, num, workers):
+        self.provider = provider
+        self.num = num
+        self.workers = workers
+        # (user, listKey) -> index of the item read last, oldest first
+        self.lastIndex = OrderedDict()
+        self.inFlight = {}  # cache key -> Future
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def onRead(self, listKey, item):
+        if self.num <= 0 or listKey is None:
+            return
+        if not self.provider.contentCache.isEnabled():
+            return
+        DirType, ID = listKey
+        records = self.provider.pathCache.getItemRecordsInAAlbum(DirType=DirType, ID=ID)
+        if records is None:
+            return
+        itemIDs = [r.getID() for r in records]
+        if item.getID() not in itemIDs:
+            return
+        index = itemIDs.index(item.getID())
+        user = getCurrentUser()
+        reader = (user, listKey)
+        with self.lock:
+            last = self.lastIndex.pop(reader, None)
+            self.lastIndex[reader] = index
+            if len(self.lastIndex) > self.MAX_READERS:
+                self.lastIndex.popitem(last=False)
+        if last is None or index != last + 1:
+            return
+        for nextItem in records[index + 1 : index + 1 + self.num]:
+            self.submit(nextItem, user=user)
+
+    def submit(self, item, user):
+        key = self.provider.getContentKey(item)
+        if item.getSize() > self.provider.contentCache.maxSize:
+            return
+        if self.provider.contentCache.has(key):
+            return
+        with self.lock:
+            if key in self.inFlight:
+                return
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="yike-prefetch"
+                )
+            self.inFlight[key] = self.pool.submit(self.fetch, key, item, user)
+
+    def fetch(self, key, item, user):
+        # counts as a transfer of user, skipped if the user has no free slot
+        try:
+            self.provider.downloadContent(item, user=user, blocking=False)
+        except Exception:
+            _logger.exception("prefetch of item {} failed".format(item.getID()))
+        finally:
+            with self.lock:
+                self.inFlight.pop(key, None)
+
+    def wait(self, key):
+        # wait for a running prefetch of key, if any
+        with self.lock:
+            future = self.inFlight.get(key, None)
+        if future is not None:
+            future.result()
+
+
+class HashingFile:
+    # file wrapper, md5 and size are computed while the data is written
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
 
 
 class onlineItem_New(DAVNonCollection):
     def __init__(self, path, environ, func_endUpload):
-        # def func_endUpload(item,api)
+        # def func_endUpload(item,api) -> bool, False if item is gone
         super().__init__(path, environ)
         self.provider = environ["wsgidav.provider"]
         self.api = self.provider.api
@@ -146,6 +954,8 @@ class onlineItem_New(DAVNonCollection):
         fileName = self.name_append_UID(fileName=fileName)
         self.tmpFilePath = os.path.join(tempfile.gettempdir(), fileName)
         self.endFunc = func_endUpload
+        self.fileobj = None
+        self.user = None  # set while a transfer slot is held
 
     def getUID(self):
         n = 1000
@@ -168,32 +978,68 @@ class onlineItem_New(DAVNonCollection):
         return False
 
     def begin_write(self, *, content_type=None):
-        return open(self.tmpFilePath, "wb")
+        # admitted before the body is received, so a busy upstream is a fast 503
+        user = getCurrentUser()
+        self.provider.transferAdmission.acquire(user)
+        self.user = user
+        self.fileobj = HashingFile(open(self.tmpFilePath, "wb"))
+        return self.fileobj
 
     def end_write(self, *, with_errors):
         """Called when PUT has finished writing.
         This is only a notification. that MAY be handled.
         """
+        try:
+            if not with_errors:
+                self.upload()
+        finally:
+            if self.user is not None:
+                self.provider.transferAdmission.release(self.user)
+                self.user = None
+            if os.path.exists(self.tmpFilePath):
+                os.remove(self.tmpFilePath)
+
+    def upload(self):
+        md5, size = self.fileobj.hexdigest(), self.fileobj.size
+        hashIndex = self.provider.hashIndex
+        item = self.provider.getItem_byHash(md5=md5, size=size)
+        if item is not None:
+            # same content was seen before: link it instead of uploading
+            if self.endFunc(item, self.api):
+                logging.debug("skip upload, link item {}".format(item.getID()))
+                return
+            logging.warning("item {} is gone, upload again".format(item.getID()))
+            hashIndex.remove(md5=md5, size=size)
         newitem = self.api.upload_1file(filePath=self.tmpFilePath)
-        os.remove(self.tmpFilePath)
+        if newitem is not None:
+            hashIndex.add(md5=md5, size=size, item=newitem)
         self.endFunc(newitem, self.api)
 
 
 class onlineItem(DAVNonCollection):
     # /All/fileName
-    def __init__(self, path, environ, item):
+    def __init__(self, path, environ, item, listKey=None):
+        # listKey = (DirType, ID) of the listing the item is read from
         self.provider = environ["wsgidav.provider"]
         super().__init__(path, environ)
         # self.environ = environ
-        self.APIitem = item
+        # item is usually an ItemRecord, the API item is created on demand
         self.item = item
+        self.listKey = listKey
+        self._APIitem = None if isinstance(item, ItemRecord) else item
+
+    @property
+    def APIitem(self):
+        if self._APIitem is None:
+            self._APIitem = self.item.toApiObj(self.provider.api)
+        return self._APIitem
 
     def get_content_length(self):
         """Returns the byte length of the content.
         MUST be implemented.
         See also _DAVResource.get_content_length()
         """
-        return self.APIitem.getSize()
+        return self.item.getSize()
 
     def get_content(self):
         """Open content as a stream for reading.
@@ -202,10 +1048,8 @@ class onlineItem(DAVNonCollection):
         The application will close() the stream.
         This method MUST be implemented by all providers.
         """
-        filestream = io.BytesIO()
-        filestream.write(self.APIitem.getContent_byRequest())
-        filestream.seek(0)  # ???
-        return filestream
+        self.provider.prefetcher.onRead(listKey=self.listKey, item=self.item)
+        return self.provider.getContentStream(self.item)
 
     def get_creation_date(self):
         return self.item.getCreationDate()
@@ -229,7 +1073,22 @@ class onlineItem(DAVNonCollection):
         return False
 
     def delete(self):
-        res = self.item.delete()
+        res = self.APIitem.delete()
+        self.provider.pathCache.removeItemFromAAlbum(
+            DirType="Item", ID="All", itemID=self.item.getID()
+        )
+        self.provider.pathCache.removeItemFromAAlbum(
+            DirType="Item", ID="ByDate", itemID=self.item.getID()
+        )
+        self.provider.pathCache.removeItemFromAAlbum(
+            DirType="ByDate",
+            ID=self.provider.getMonthKey(self.item),
+            itemID=self.item.getID(),
+        )
+        self.provider.pathCache.deleteItemIfExist(
+            itemID=self.item.getID(), name=self.item.getName()
+        )
+        self.provider.hashIndex.removeByID(self.item.getID())
 
     def handle_delete(self):
         _logger.debug(f"handle_delete...")
@@ -240,7 +1099,12 @@ class onlineItem(DAVNonCollection):
 class onlineItemInAAlbum(onlineItem):
     # /TypeMarker/dirName/fileName
     def __init__(self, path, environ, item, AbsAlbumType, aalb):
-        super().__init__(path=path, environ=environ, item=item)
+        super().__init__(
+            path=path,
+            environ=environ,
+            item=item,
+            listKey=None if aalb is None else (AbsAlbumType, aalb.getID()),
+        )
         self.alb = aalb
         self.AbsAlbumType = AbsAlbumType
 
@@ -251,10 +1115,62 @@ class onlineItemInAAlbum(onlineItem):
                 isOrigin=self.provider.config["ALBUM_ITEM_DELETE_WITH_ORIGIN"],
             )
             logging.debug(res)
+            self.provider.pathCache.removeItemFromAAlbum(
+                DirType=self.AbsAlbumType, ID=self.alb.getID(), itemID=self.item.getID()
+            )
         else:
             pass
 
 
+class onlineThumbnail(DAVNonCollection):
+    # /.../.thumbs/fileName, the server side thumbnail of an item
+    def __init__(self, path, environ, item, fromLibrary=False):
+        # fromLibrary: the item is in an album, its url is from a library list
+        self.provider = environ["wsgidav.provider"]
+        super().__init__(path, environ)
+        self.item = item
+        self.fromLibrary = fromLibrary
+
+    def get_content_length(self):
+        # unknown before the thumbnail is downloaded, then read until EOF
+        return self.provider.thumbnailCache.getSize(
+            self.provider.getContentKey(self.item)
+        )
+
+    def get_content_type(self):
+        return "image/jpeg"
+
+    def get_content(self):
+        return self.provider.getThumbnailStream(self.item, fromLibrary=self.fromLibrary)
+
+    def get_creation_date(self):
+        return self.item.getCreationDate()
+
+    def get_last_modified(self):
+        return self.item.getModificationDate()
+
+    def get_etag(self):
+        return None
+
+    def support_etag(self):
+        return False
+
+
+class Dir_Thumbs(DAVCollection):
+    # /.../.thumbs, thumbnails of the items of the parent dir
+    def __init__(self, path, environ, parent):
+        self.provider = environ["wsgidav.provider"]
+        self.parent = parent
+        super().__init__(path, environ)
+
+    def get_member_names(self):
+        records = self.parent.getItemRecords()
+        urls = self.provider.getThumbURLs(
+            records, fromLibrary=isinstance(self.parent, Dir_Alum_Abstract)
+        )
+        return [r.getName() for r in records if r.getID() in urls]
+
+
 class Dir_root(DAVCollection):
     def __init__(self, path, environ):
         self.provider = environ["wsgidav.provider"]
@@ -264,7 +1180,10 @@ class Dir_root(DAVCollection):
         """Return list of (direct) collection member names (UTF-8 byte strings).
         This method MUST be implemented.
         """
-        return [self.provider.get_AllDirName()] + self.provider.getAlbumTypes()
+        return [
+            self.provider.get_AllDirName(),
+            self.provider.get_DateDirName(),
+        ] + self.provider.getAlbumTypes()
 
 
 class Dir_All(DAVCollection):
@@ -272,15 +1191,42 @@ class Dir_All(DAVCollection):
         self.provider = environ["wsgidav.provider"]
         super().__init__(path, environ)
 
+    def getItemRecords(self):
+        return self.provider.syncAllItems()
+
     def get_member_names(self):
-        names = []
-        items = self.provider.api.get_self_All(
-            typeName="Item", max=self.provider.config["ITEM_NUM_MAX_IN_DIR"]
-        )
-        for item in items:
-            self.provider.pathCache.cacheItem(item)
-            names.append(item.getName())
-        return names
+        records = self.getItemRecords()
+        return self.provider.getItemNames(records) + self.provider.getThumbDirNames()
+
+
+class Dir_ByDate(DAVCollection):
+    # /ByDate, /ByDate/year, /ByDate/year/month
+    def __init__(self, path, environ, dateParts):
+        self.provider = environ["wsgidav.provider"]
+        self.dateParts = dateParts
+        super().__init__(path, environ)
+
+    def get_member_names(self):
+        months = self.provider.syncDateTree()
+        if len(self.dateParts) == 0:
+            years = []
+            for month in months:
+                if month[:4] not in years:
+                    years.append(month[:4])
+            return years
+        elif len(self.dateParts) == 1:
+            return [m[5:] for m in months if m[:4] == self.dateParts[0]]
+        else:
+            records = self.getItemRecords()
+            return (
+                self.provider.getItemNames(records) + self.provider.getThumbDirNames()
+            )
+
+    def getItemRecords(self):
+        # only for /ByDate/year/month
+        assert len(self.dateParts) == 2
+        records = self.provider.syncDateTree(month="-".join(self.dateParts))
+        return [] if records is None else records
 
 
 class Dir_TypeMarker_s(DAVCollection):
@@ -293,7 +1239,8 @@ class Dir_TypeMarker_s(DAVCollection):
 
     def get_AbsAlbum_List(self):
         MaxDir = self.provider.config["ABSALUM_MAX_IN_DIR"]
-        List = self.provider.api.get_self_All(typeName=self.TypeMarker, max=MaxDir)
+        with self.provider.listingAdmission.slot():
+            List = self.provider.api.get_self_All(typeName=self.TypeMarker, max=MaxDir)
         if List is None:
             return []
         else:
@@ -353,38 +1300,25 @@ class Dir_Alum_Abstract(DAVCollection):
             return shownName.split(delimiter)[-1]
 
     @staticmethod
-    def cacheItemsInSelfDir_byRequest(provider, TypeMarker, apiObj):
+    def cacheItemsInSelfDir_byRequest(provider, TypeMarker, apiObj, force=False):
+        # return item records in the dir, only the change since last sync is requested
         maxNum = provider.config["ITEM_NUM_MAX_IN_" + TypeMarker.upper()]
-        items = apiObj.get_sub_All(max=maxNum)
-        for item in items:
-            provider.pathCache.cacheItem(item=item)
-        return items
+        return provider.syncItemList(
+            DirType=TypeMarker,
+            ID=apiObj.getID(),
+            SinglePageFunc=apiObj.get_sub_1page,
+            maxNum=maxNum,
+            force=force,
+        )
 
-    def get_member_names(self):
-        maxNum = self.provider.config["ITEM_NUM_MAX_IN_" + self.TypeMarker.upper()]
-        l = self.provider.pathCache.getItemListInAAlbum(
-            DirType=self.TypeMarker, ID=self.apiObj.getID()
+    def getItemRecords(self):
+        return self.cacheItemsInSelfDir_byRequest(
+            provider=self.provider, TypeMarker=self.TypeMarker, apiObj=self.apiObj
         )
-        if l is None:
-            items = self.cacheItemsInSelfDir_byRequest(
-                provider=self.provider, TypeMarker=self.TypeMarker, apiObj=self.apiObj
-            )
-            # items = self.apiObj.get_sub_All(max=maxNum)
-            # for item in items:
-            #     self.provider.pathCache.cacheItem(item=item)
-        else:
-            items = []
-            for itemID in l:
-                info = self.provider.pathCache.getItemInfo(itemID=itemID)
-                if info is None:
-                    logging.error(
-                        "need to request item by itemID and insert into cache"
-                    )
-                else:
-                    item = self.provider.api.getOnlineItem_ByInfo(info=info)
-                items.append(item)
-        names = [item.getName() for item in items]
-        return names
+
+    def get_member_names(self):
+        records = self.getItemRecords()
+        return self.provider.getItemNames(records) + self.provider.getThumbDirNames()
 
     def handle_move(self, dest_path):
         # 只用来重命名，不改变位置
@@ -417,17 +1351,33 @@ class Dir_Alum_Abstract(DAVCollection):
 
         assert self.TypeMarker == "Album"
 
+        def isInAlbum(item, force=False):
+            records = self.cacheItemsInSelfDir_byRequest(
+                provider=self.provider,
+                TypeMarker=self.TypeMarker,
+                apiObj=self.apiObj,
+                force=force,
+            )
+            return any(r.getID() == item.getID() for r in records)
+
         def fun(item, api):
             alb = self.apiObj  # self.provider.getAlumb_byCacheOrRequest(ID=self.albID)
-            alb.append(item)
-            self.provider.pathCache.cacheItem(item)
+            if isInAlbum(item):
+                return True  # the same content PUT again
+            res = alb.append(item)
+            if res is None or res.get("errno", 0) != 0:
+                # upstream has no request of an item by ID: the item is taken
+                # as gone unless the rejected link is in the album anyway
+                return isInAlbum(item, force=True)
+            record = self.provider.pathCache.cacheItem(item)
             # self.provider.pathCache.setAlbumList(albID=self.albID, itemID=item.getID())
             self.provider.pathCache.appendItemIntoAAlbum(
                 DirType=self.TypeMarker,
                 ID=alb.getID(),
-                itemID=item.getID(),
+                item=record,
                 checkTableExist=True,
             )
+            return True
 
         return onlineItem_New(
             path=pathjoin(self.path, name), environ=self.environ, func_endUpload=fun
@@ -446,11 +1396,120 @@ class Dir_Alum_Abstract(DAVCollection):
 
 
 class baiduphoto(DAVProvider):
-    def __init__(self, config, api):
+    def __init__(self, config, api=None):
+        # api can be None, then it is created later by initInBackground
         super().__init__()
-        self.pathCache = PathCache(AlbumTypes=self.getAlbumTypes())
+        self.pathCache = PathCache(
+            AlbumTypes=self.getAlbumTypes(),
+            maxMemory=int(config["CACHE_MEMORY_MAX_MB"] * 1024 * 1024),
+        )
         self.config = config
-        self.api = api
+        self.hashIndex = HashIndex(filePath=config["HASH_INDEX_FILE"])
+        self.contentCache = ContentCache(
+            dirPath=config["CONTENT_CACHE_DIR"]
+            or os.path.join(tempfile.gettempdir(), "webdav-yike"),
+            maxSize=int(config["CONTENT_CACHE_MAX_MB"] * 1024 * 1024),
+        )
+        # thumbnails have their own budget, so they do not evict the contents
+        self.thumbnailCache = ContentCache(
+            dirPath=os.path.join(self.contentCache.dirPath, "thumbs"),
+            maxSize=int(config["THUMBNAIL_CACHE_MAX_MB"] * 1024 * 1024),
+        )
+        self.prefetcher = Prefetcher(
+            provider=self,
+            num=config["PREFETCH_NUM"],
+            workers=config["PREFETCH_WORKERS"],
+        )
+        # separate pools, so listings do not wait behind bulk downloads
+        self.transferAdmission = self.createAdmissionControl()
+        self.listingAdmission = self.createAdmissionControl()
+        self._api = api
+        self._apiError = None
+        self._apiReady = threading.Event()
+        if api is not None:
+            self._apiReady.set()
+        self._closed = threading.Event()
+        self._dateTreeFullSync = threading.Lock()  # held while it runs
+
+    @property
+    def api(self):
+        # requests arriving before the API is ready wait for it (bounded)
+        if not self._apiReady.wait(timeout=self.config["API_INIT_TIMEOUT"]):
+            raise DAVError(HTTP_SERVICE_UNAVAILABLE, "API is still initializing")
+        if self._api is None:
+            raise DAVError(
+                HTTP_SERVICE_UNAVAILABLE,
+                "API initialization failed: {}".format(self._apiError),
+            )
+        return self._api
+
+    def initInBackground(self, apiFactory):
+        # def apiFactory() -> API
+        def run():
+            t0 = time.time()
+            try:
+                self._api = apiFactory()
+            except Exception as e:
+                self._apiError = e
+                _logger.exception("API initialization failed")
+            finally:
+                self._apiReady.set()
+            if self._api is not None:
+                _logger.info("API ready after {:.3f}s".format(time.time() - t0))
+            self.loadLocalState()
+            _logger.info("local caches loaded after {:.3f}s".format(time.time() - t0))
+            if self._api is None:
+                return
+            if self.config["WARMUP_ON_START"]:
+                self.warmUpCache()
+                _logger.info(
+                    "cache warm-up finished after {:.3f}s".format(time.time() - t0)
+                )
+
+        thread = threading.Thread(target=run, name="yike-init", daemon=True)
+        thread.start()
+        threading.Thread(target=self.runAutoSave, name="yike-save", daemon=True).start()
+        return thread
+
+    def loadLocalState(self):
+        # hash index and disk caches of an earlier run, errors are not fatal
+        try:
+            self.hashIndex.load()
+            self.contentCache.load()
+            self.thumbnailCache.load()
+        except Exception:
+            _logger.exception("cannot load local caches")
+
+    def runAutoSave(self):
+        while not self._closed.wait(timeout=self.config["HASH_INDEX_SAVE_INTERVAL"]):
+            self.hashIndex.save()
+
+    def close(self):
+        # at shutdown
+        self._closed.set()
+        self.hashIndex.save()
+
+    def warmUpCache(self):
+        # fill pathCache with the top level listings, errors are not fatal
+        try:
+            self.syncAllItems()
+            for TypeMarker in self.getAlbumTypes():
+                albList = self.api.get_self_All(
+                    typeName=TypeMarker, max=self.config["ABSALUM_MAX_IN_DIR"]
+                )
+                for alb in albList or []:
+                    self.pathCache.cache_apiObj(TypeMarker=TypeMarker, apiObj=alb)
+        except Exception:
+            _logger.exception("cache warm-up failed")
+
+    def createAdmissionControl(self):
+        return AdmissionControl(
+            maxTotal=self.config["UPSTREAM_MAX_TOTAL"],
+            maxPerUser=self.config["UPSTREAM_MAX_PER_USER"],
+            maxQueuePerUser=self.config["UPSTREAM_MAX_QUEUE_PER_USER"],
+            timeout=self.config["UPSTREAM_QUEUE_TIMEOUT"],
+            retryAfter=self.config["UPSTREAM_RETRY_AFTER"],
+        )
 
     def getDelimiter(self):
         return self.config["DELIMITER"]
@@ -491,7 +1550,8 @@ class baiduphoto(DAVProvider):
             logging.debug("apiObj [{},{}] not in cache".format(TypeMarker, ID))
             if fun_Req is not None:
                 logging.debug("Viable to request info to get apiObj")
-                apiObj = fun_Req(ID=ID)
+                with self.listingAdmission.slot():
+                    apiObj = fun_Req(ID=ID)
                 self.pathCache.cache_apiObj(TypeMarker=TypeMarker, apiObj=apiObj)
                 return apiObj
             else:
@@ -505,7 +1565,8 @@ class baiduphoto(DAVProvider):
                         TypeMarker
                     )
                 )
-                apiObjs = fun_ListAll()
+                with self.listingAdmission.slot():
+                    apiObjs = fun_ListAll()
                 for o in apiObjs:
                     self.pathCache.cache_apiObj(TypeMarker=TypeMarker, apiObj=o)
                 info = self.pathCache.getapiObjInfo(TypeMarker=TypeMarker, ID=ID)
@@ -538,52 +1599,43 @@ class baiduphoto(DAVProvider):
     def getItem_byNameWithCache(self, Name, paths):
         ID = self.pathCache.getItemIDByName(Name)
         if ID is None:
+            # the item may have been evicted, look it up in the synced list
             if paths[0] == self.get_AllDirName():
-                return None
-            if hasattr(self, "requestItemByfileName"):
-                item = self.requestItemByfileName(Name)
-                self.pathCache.cache_apiObj(TypeMarker="Item", apiObj=item)
-                return item
-            else:
-                logging.warning(
-                    "need to implement request id by filename, path=[{}]".format(paths)
-                )
-                if paths[0] == self.get_AllDirName():
-                    logging.warning("As a compromise, reload all items, this is slow!")
-                    items = self.api.getAllItems(max=self.config["ITEM_NUM_MAX_IN_DIR"])
-                    for item in items:
-                        self.pathCache.cache_apiObj(TypeMarker="Item", apiObj=item)
-                    ID = self.pathCache.getItemIDByName(Name)
-                    if ID is None:
-                        logging.error(
-                            "item name {} not found. Consider increasing ITEM_NUM_MAX_IN_DIR or set it as -1".format(
-                                name
-                            )
-                        )
-                        return None
-                    else:
-                        return self.getItem_byCache(ID)
-                else:  # /TypeMarker/dirName/fileName
-                    aalbID = Dir_Alum_Abstract.getIDByShownName(
-                        provider=self, shownName=paths[1]
-                    )
-                    aalb = self.get_apiObj_byCacheOrRequest(
-                        TypeMarker=paths[0], ID=aalbID
-                    )
-                    Null = Dir_Alum_Abstract.cacheItemsInSelfDir_byRequest(
-                        provider=self, TypeMarker=paths[0], apiObj=aalb
+                records = self.syncAllItems()
+            elif paths[0] == self.get_DateDirName():
+                records = self.syncDateTree(month="-".join(paths[1:3]))
+            else:  # /TypeMarker/dirName/fileName
+                records = self.getItemRecordsInAlbumPath(paths)
+            item = self.findItemByName(records=records or [], Name=Name)
+            if item is None:
+                if paths[0] not in [self.get_AllDirName(), self.get_DateDirName()]:
+                    logging.error(
+                        "cannot load item information. Considering cd to root dir".format()
                     )
-                    ID = self.pathCache.getItemIDByName(Name)
-                    if ID is None:
-                        logging.error(
-                            "cannot load item information. Considering cd to root dir".format()
-                        )
-                        return None
-                    else:
-                        return self.getItem_byCache(ID)
+                return None
+            return self.pathCache.cacheItem(item)
         else:
             return self.getItem_byCache(ID)
 
+    def getItemRecordsInAlbumPath(self, paths):
+        # /TypeMarker/dirName/..., the cached list holds the records of evicted
+        # items; it is synced (not forced) only if not cached
+        aalbID = Dir_Alum_Abstract.getIDByShownName(provider=self, shownName=paths[1])
+        records = self.pathCache.getItemRecordsInAAlbum(DirType=paths[0], ID=aalbID)
+        if records is None:
+            aalb = self.get_apiObj_byCacheOrRequest(TypeMarker=paths[0], ID=aalbID)
+            records = Dir_Alum_Abstract.cacheItemsInSelfDir_byRequest(
+                provider=self, TypeMarker=paths[0], apiObj=aalb
+            )
+        return records
+
+    @staticmethod
+    def findItemByName(records, Name):
+        for record in records:
+            if record.getName() == Name:
+                return record
+        return None
+
     # ====================================================
     # best to implement
     #
@@ -594,12 +1646,490 @@ class baiduphoto(DAVProvider):
     #     # return item
     # ====================================================
 
-    def getItem_byCache(self, ID):
-        info = self.pathCache.getItemInfo(itemID=ID)
-        if info is None:
-            logging.warning("not in cache, No way to obtain it")
+    def getSyncLock(self, DirType, ID):
+        # one sync of a list at a time, readers of a fresh list do not take it
+        return self.pathCache.getSyncLock(DirType=DirType, ID=ID)
+
+    def getFreshItemList(self, DirType, ID):
+        # the cached records if synced within SYNC_INTERVAL, else None
+        state = self.pathCache.getSyncState(DirType=DirType, ID=ID)
+        if (
+            state is None
+            or time.time() - state["syncTime"] >= self.config["SYNC_INTERVAL"]
+        ):
+            return None
+        return self.pathCache.getItemRecordsInAAlbum(DirType=DirType, ID=ID)
+
+    def syncItemList(self, DirType, ID, SinglePageFunc, maxNum, force=False):
+        records, changes = self._syncItemList(
+            DirType=DirType,
+            ID=ID,
+            SinglePageFunc=SinglePageFunc,
+            maxNum=maxNum,
+            force=force,
+        )
+        return records
+
+    def _syncItemList(
+        self,
+        DirType,
+        ID,
+        SinglePageFunc,
+        maxNum,
+        force=False,
+        onReplace=None,
+        blocking=True,
+        timedFull=True,
+    ):
+        # Return (ItemRecords, changes) of the list, synced if not fresh.
+        # onReplace(records, changes) is called while the list lock is held,
+        # right after the cached list is replaced.
+        # Not blocking: the cached list is returned while another sync runs.
+        # timedFull=False: no full sync because of FULL_SYNC_INTERVAL.
+        if not force:
+            known = self.getFreshItemList(DirType=DirType, ID=ID)
+            if known is not None:
+                return known, ([], [])
+        syncLock = self.getSyncLock(DirType=DirType, ID=ID)
+        if not syncLock.acquire(blocking=False):
+            known = self.pathCache.getItemRecordsInAAlbum(DirType=DirType, ID=ID)
+            if not blocking and known is not None:
+                return known, ([], [])
+            syncLock.acquire()
+        try:
+            if not force:
+                # synced by another request meanwhile
+                known = self.getFreshItemList(DirType=DirType, ID=ID)
+                if known is not None:
+                    return known, ([], [])
+            return self._fetchItemList(
+                DirType=DirType,
+                ID=ID,
+                SinglePageFunc=SinglePageFunc,
+                maxNum=maxNum,
+                onReplace=onReplace,
+                timedFull=timedFull,
+            )
+        finally:
+            syncLock.release()
+
+    def _fetchItemList(self, DirType, ID, SinglePageFunc, maxNum, onReplace, timedFull):
+        # Delta sync of the item list of a dir, return (ItemRecords, changes).
+        # changes = (new or modified records, removed or replaced records),
+        # None if unknown (no cached list before, or maxNum > 0).
+        #
+        # Upstream lists the newest items first, but by creation date: an
+        # item uploaded now with an old creation date shows up further down.
+        # Pages are requested until an item that is already cached (and not
+        # modified since the watermark) has shown up and a whole page brought
+        # nothing newer than the watermark; everything below the last cached
+        # item seen is kept from the cached list. Cached items above it which
+        # were not returned have been deleted. New items and deletions further
+        # down are found by the periodic full sync (FULL_SYNC_INTERVAL).
+        # The cached list holds its records, evicted records in the Item
+        # table do not make it incomplete; an evicted list is synced in full.
+        # The sync lock is held. Pages are requested without the list lock,
+        # items appended or removed meanwhile are merged in when the list is
+        # replaced.
+        now = time.time()
+        state = self.pathCache.getSyncState(DirType=DirType, ID=ID)
+        known = self.pathCache.getItemRecordsInAAlbum(DirType=DirType, ID=ID)
+        isFull = (
+            state is None
+            or known is None
+            or (
+                timedFull
+                and now - state["fullSyncTime"] >= self.config["FULL_SYNC_INTERVAL"]
+            )
+        )
+        watermark = None if isFull else state["watermark"]
+        knownIndex = {}  # item ID -> position in the cached list
+        for i, record in enumerate(known or []):
+            knownIndex[record.getID()] = i
+
+        # the list being built is not evicted before it is returned
+        with self.pathCache.pinList(DirType=DirType, ID=ID):
+            fetched = []
+            lastKnown = None  # the last cached item seen
+            isAnchored = False  # an unmodified cached item was seen
+            isEnd = False
+            cursor = None
+            while True:
+                with self.listingAdmission.slot():
+                    page = SinglePageFunc(cursor=cursor)
+                if self.config["THUMBNAIL_DIR_NAME"]:
+                    self.cacheThumbURLs(page["items"], DirType=DirType, ID=ID)
+                hasNewer = False
+                for item in page["items"]:
+                    fetched.append(item)
+                    if item.getID() in knownIndex:
+                        lastKnown = item.getID()
+                    if watermark is None or item.getModificationDate() > watermark:
+                        hasNewer = True
+                    elif item.getID() in knownIndex:
+                        isAnchored = True
+                if not page["has_more"]:
+                    isEnd = True
+                    break
+                if isAnchored and not hasNewer:
+                    break
+                if maxNum > 0 and len(fetched) >= maxNum:
+                    break
+                cursor = page["cursor"]
+
+            # unchanged items keep their cached record, so the lists sharing
+            # it (ByDate months) stay valid
+            records = []
+            changed = []  # new or modified
+            removed = []  # removed, or the old record of a modified item
+            for item in fetched:
+                i = knownIndex.get(item.getID(), None)
+                if i is not None and self.isSameItem(known[i], item):
+                    records.append(self.pathCache.cacheItem(known[i], overwrite=True))
+                    continue
+                records.append(self.pathCache.cacheItem(item, overwrite=True))
+                changed.append(records[-1])
+                if i is not None:
+                    removed.append(known[i])
+            fetchedSet = set(r.getID() for r in records)
+            covered = known  # the part of the cached list listed again
+            if not isEnd and lastKnown is not None:
+                index = knownIndex[lastKnown]
+                covered = known[: index + 1]
+                records += [
+                    r for r in known[index + 1 :] if r.getID() not in fetchedSet
+                ]
+            removed += [r for r in covered or [] if r.getID() not in fetchedSet]
+            if maxNum > 0:
+                records = records[:maxNum]
+            mtimes = [item.getModificationDate() for item in fetched]
+            if watermark is not None:
+                mtimes.append(watermark)
+
+            with self.pathCache.getListLock(DirType=DirType, ID=ID):
+                current = self.pathCache.getItemRecordsInAAlbum(DirType=DirType, ID=ID)
+                if current is not None:
+                    # appended (uploaded) or removed (deleted) while paging
+                    knownSet = set(r.getID() for r in known or [])
+                    currentSet = set(r.getID() for r in current)
+                    fetchedSet = set(r.getID() for r in records)
+                    gone = knownSet - currentSet
+                    records = [
+                        r
+                        for r in current
+                        if r.getID() not in knownSet and r.getID() not in fetchedSet
+                    ] + [r for r in records if r.getID() not in gone]
+                    changed = [r for r in changed if r.getID() not in gone]
+                if maxNum > 0 or known is None:
+                    changes = None
+                else:
+                    changes = (changed, removed)
+                self.pathCache.setItemListInAAlbum(
+                    DirType=DirType, ID=ID, items=records
+                )
+                self.pathCache.setSyncState(
+                    DirType=DirType,
+                    ID=ID,
+                    state={
+                        "watermark": max(mtimes) if len(mtimes) > 0 else 0,
+                        "syncTime": now,
+                        "fullSyncTime": now if isFull else state["fullSyncTime"],
+                    },
+                )
+                if onReplace is not None:
+                    onReplace(records, changes)
+        logging.debug(
+            "sync [{},{}]: full={}, fetched={}, total={}".format(
+                DirType, ID, isFull, len(fetched), len(records)
+            )
+        )
+        return records, changes
+
+    @staticmethod
+    def isSameItem(record, item):
+        return (
+            record.getModificationDate() == item.getModificationDate()
+            and record.getCreationDate() == item.getCreationDate()
+            and record.getName() == item.getName()
+        )
+
+    @staticmethod
+    def getMonthKey(item):
+        t = time.localtime(item.getCreationDate())
+        return "{:04d}-{:02d}".format(t.tm_year, t.tm_mon)
+
+    def syncDateTree(self, month=None, force=False):
+        # Split the whole library into one list per month of creation date.
+        # Upstream has no time-range query, so the (delta synced) full item
+        # list is bucketed locally; a sync only updates the months it changed.
+        # Requests only run delta syncs, and are served from the cached tree
+        # while another sync runs: the full sync (FULL_SYNC_INTERVAL) lists the
+        # whole library and runs in the background.
+        # Return the months, or the ItemRecords of month (None if no such month)
+        with self.pathCache.pinList(
+            DirType="Item", ID="ByDate"
+        ), self.pathCache.pinList(DirType="ByDate"):
+            if self.pathCache.getDateTreeSyncTime() is None:
+                # the month lists were evicted, rebuild them from the list
+                with self.pathCache.getListLock(DirType="Item", ID="ByDate"):
+                    state = self.pathCache.getSyncState(DirType="Item", ID="ByDate")
+                    records = self.pathCache.getItemRecordsInAAlbum(
+                        DirType="Item", ID="ByDate"
+                    )
+                    if state is not None and records is not None:
+                        self.updateDateBuckets(records, None)
+            self._syncItemList(
+                DirType="Item",
+                ID="ByDate",
+                SinglePageFunc=self.getItemPage,
+                maxNum=0,
+                force=force,
+                onReplace=self.updateDateBuckets,
+                blocking=False,
+                timedFull=False,
+            )
+            self.startDateTreeFullSync()
+            if month is None:
+                return self.pathCache.getDateMonths()
+            return self.pathCache.getItemRecordsInAAlbum(DirType="ByDate", ID=month)
+
+    def startDateTreeFullSync(self):
+        # start the full sync of the date tree if it is due and not running
+        state = self.pathCache.getSyncState(DirType="Item", ID="ByDate")
+        if (
+            state is None
+            or time.time() - state["fullSyncTime"] < self.config["FULL_SYNC_INTERVAL"]
+        ):
+            return
+        if not self._dateTreeFullSync.acquire(blocking=False):
+            return  # running
+
+        def run():
+            try:
+                with self.pathCache.pinList(
+                    DirType="Item", ID="ByDate"
+                ), self.pathCache.pinList(DirType="ByDate"):
+                    self._syncItemList(
+                        DirType="Item",
+                        ID="ByDate",
+                        SinglePageFunc=self.getItemPage,
+                        maxNum=0,
+                        force=True,
+                        onReplace=self.updateDateBuckets,
+                    )
+            except Exception:
+                _logger.exception("full sync of the date tree failed")
+            finally:
+                self._dateTreeFullSync.release()
+
+        threading.Thread(target=run, name="yike-fullsync", daemon=True).start()
+
+    def updateDateBuckets(self, records, changes):
+        # the list lock of Item_list_ByDate is held
+        syncTime = self.pathCache.getSyncState(DirType="Item", ID="ByDate")["syncTime"]
+        if self.pathCache.getDateTreeSyncTime() is None or changes is None:
+            # first time, or a month list was evicted: bucket everything
+            buckets = {}
+            for record in records:
+                buckets.setdefault(self.getMonthKey(record), []).append(record)
+            self.pathCache.setDateBuckets(
+                buckets={m: self.sortByDate(b) for m, b in buckets.items()},
+                syncTime=syncTime,
+            )
+        elif len(changes[0]) > 0 or len(changes[1]) > 0:
+            # only the months of the new, modified and removed items
+            changed, removed = changes
+            dropped = set(r.getID() for r in changed + removed)
+            buckets = {}
+            for record in removed + changed:
+                month = self.getMonthKey(record)
+                if month not in buckets:
+                    old = self.pathCache.getItemRecordsInAAlbum(
+                        DirType="ByDate", ID=month
+                    )
+                    buckets[month] = [r for r in old or [] if r.getID() not in dropped]
+            for record in changed:
+                buckets[self.getMonthKey(record)].append(record)
+            self.pathCache.setDateBuckets(
+                buckets={m: self.sortByDate(b) for m, b in buckets.items()},
+                syncTime=syncTime,
+                isComplete=False,
+            )
+
+    @staticmethod
+    def sortByDate(records):
+        # newest first, like the upstream listing
+        return sorted(records, key=lambda r: r.getCreationDate(), reverse=True)
+
+    def getItemPage(self, cursor=None):
+        # same as api.get_self_1page(typeName="Item"), with the thumbnail urls
+        # if the thumbnail dirs are enabled
+        params = {"clienttype": 70, "need_filter_hidden": 0}
+        if self.config["THUMBNAIL_DIR_NAME"]:
+            params["need_thumbnail"] = 1
+        if cursor is not None:
+            params["cursor"] = cursor
+        pageInfo = self.api.req.getReqJson(
+            url="https://photo.baidu.com/youai/file/v1/list", params=params
+        )
+        return {
+            "items": [self.api.getOnlineItem_ByInfo(info=i) for i in pageInfo["list"]],
+            "has_more": pageInfo["has_more"] == 1,
+            "cursor": pageInfo["cursor"],
+        }
+
+    def syncAllItems(self):
+        return self.syncItemList(
+            DirType="Item",
+            ID="All",
+            SinglePageFunc=self.getItemPage,
+            maxNum=self.config["ITEM_NUM_MAX_IN_DIR"],
+        )
+
+    @staticmethod
+    def getItemNames(records):
+        return [record.getName() for record in records]
+
+    @staticmethod
+    def getContentKey(item):
+        # mtime in the key, so a modified item is not served from old content
+        return "{}_{}".format(item.getID(), item.getModificationDate())
+
+    def downloadContent(self, item, user=None, blocking=True):
+        # return None if not blocking and no transfer slot is free
+        if isinstance(item, ItemRecord):
+            APIitem = item.toApiObj(self.api)
+        else:
+            APIitem = item
+        user = getCurrentUser() if user is None else user
+        if not self.transferAdmission.acquire(user, blocking=blocking):
+            return None
+        try:
+            content = APIitem.getContent_byRequest()
+        finally:
+            self.transferAdmission.release(user)
+        self.hashIndex.add(
+            md5=hashlib.md5(content).hexdigest(), size=len(content), item=item
+        )
+        if self.contentCache.isEnabled():
+            self.contentCache.put(self.getContentKey(item), content)
+        return content
+
+    def getContentStream(self, item):
+        key = self.getContentKey(item)
+        self.prefetcher.wait(key)
+        filestream = self.contentCache.open(key)
+        if filestream is not None:
+            return filestream
+        filestream = io.BytesIO()
+        filestream.write(self.downloadContent(item))
+        filestream.seek(0)  # ???
+        return filestream
+
+    def getThumbDirNames(self):
+        name = self.config["THUMBNAIL_DIR_NAME"]
+        return [name] if name else []
+
+    def cacheThumbURLs(self, items, DirType, ID):
+        # "thumburl" is only in the library listings requested with
+        # need_thumbnail, album listings have none and keep the cached urls
+        for item in items:
+            url = item.getInfo().get("thumburl", None)
+            if isinstance(url, list):
+                url = url[0] if len(url) > 0 else None
+            if url is not None:
+                self.pathCache.setThumbURL(
+                    itemID=item.getID(), url=url, DirType=DirType, ID=ID
+                )
+
+    def syncThumbSource(self, listKey, force=False):
+        if listKey == ("Item", "All"):
+            self.syncItemList(
+                DirType="Item",
+                ID="All",
+                SinglePageFunc=self.getItemPage,
+                maxNum=self.config["ITEM_NUM_MAX_IN_DIR"],
+                force=force,
+            )
         else:
-            return self.api.getOnlineItem_ByInfo(info=info)
+            self.syncDateTree(force=force)
+
+    def getThumbURLs(self, records, fromLibrary=False):
+        # {item ID: thumbnail url} of the records which have one.
+        # The items of an album get theirs from the library lists, which are
+        # synced first (the whole library if not cached yet).
+        entries = {}
+        for record in records:
+            entries[record.getID()] = self.pathCache.getThumbURL(record.getID())
+        if fromLibrary:
+            sources = set(e[1] for e in entries.values() if e is not None)
+            if None in entries.values():
+                sources.add(("Item", "ByDate"))
+            for listKey in sorted(sources):
+                self.syncThumbSource(listKey)
+            for ID in entries:
+                entries[ID] = self.pathCache.getThumbURL(ID)
+        return {ID: e[0] for ID, e in entries.items() if e is not None}
+
+    def getThumbnailURL(self, url):
+        size = self.config["THUMBNAIL_SIZE"]
+        if size:
+            url = re.sub(r"size=[^&]*", "size=" + size, url)
+        return url
+
+    def requestThumbnail(self, url):
+        # thumbnails are small, they take a listing slot and not a transfer one
+        with self.listingAdmission.slot():
+            return self.api.req.get(url=self.getThumbnailURL(url))
+
+    def getThumbnailStream(self, item, fromLibrary=False):
+        key = self.getContentKey(item)
+        filestream = self.thumbnailCache.open(key)
+        if filestream is not None:
+            return filestream
+        entry = self.pathCache.getThumbURL(item.getID())
+        if entry is None and fromLibrary:
+            self.getThumbURLs([item], fromLibrary=True)
+            entry = self.pathCache.getThumbURL(item.getID())
+        if entry is None:
+            raise DAVError(HTTP_NOT_FOUND, "no thumbnail url cached")
+        url, sourceListKey = entry
+        response = self.requestThumbnail(url)
+        if response.status_code != 200:
+            # the url is signed and expires, a full sync of the list which
+            # returned it gets a new one. /All is capped and synced now; the
+            # date tree only gets the new urls of its first pages now, the
+            # full sync runs in the background.
+            self.pathCache.expireFullSync(DirType=sourceListKey[0], ID=sourceListKey[1])
+            self.syncThumbSource(sourceListKey, force=True)
+            entry = self.pathCache.getThumbURL(item.getID())
+            if entry is not None and entry[0] != url:
+                response = self.requestThumbnail(entry[0])
+        if response.status_code != 200:
+            raise DAVError(
+                HTTP_BAD_GATEWAY,
+                "thumbnail request failed: {}".format(response.status_code),
+            )
+        content = response.content
+        if self.thumbnailCache.isEnabled():
+            self.thumbnailCache.put(key, content)
+        return io.BytesIO(content)
+
+    def getItem_byHash(self, md5, size):
+        info = self.hashIndex.get(md5=md5, size=size)
+        if info is None:
+            return None
+        record = self.pathCache.getItemRecord(itemID=info["fsid"])
+        if record is None:
+            record = ItemRecord.fromInfo(info)
+        return record
+
+    def getItem_byCache(self, ID):
+        # return ItemRecord, no request
+        record = self.pathCache.getItemRecord(itemID=ID)
+        if record is None:
+            logging.debug("item [{}] not in cache, list its dir again".format(ID))
+        return record
 
     def get_AllDirName(self):
         maxNum = int(self.config["ITEM_NUM_MAX_IN_DIR"])
@@ -608,6 +2138,9 @@ class baiduphoto(DAVProvider):
         else:
             return "All(latest{})".format(maxNum)
 
+    def get_DateDirName(self):
+        return "ByDate"
+
     @staticmethod
     def matchFileNamePrefix(fileName):
         blackList = [
@@ -642,6 +2175,36 @@ class baiduphoto(DAVProvider):
         if path == "/":
             return Dir_root(path=path, environ=environ)
 
+        ########################################################
+        #           thumbnails
+        #
+        # path = /.../dir/.thumbs
+        #      = /.../dir/.thumbs/fileName
+        ########################################################
+        thumbDirName = self.config["THUMBNAIL_DIR_NAME"]
+        if thumbDirName and thumbDirName in paths:
+            i = paths.index(thumbDirName)
+            parentPath = "/" + "/".join(paths[:i])
+            if i == len(paths) - 1:
+                parent = self.get_resource_inst(parentPath, environ)
+                if not hasattr(parent, "getItemRecords") or (
+                    isinstance(parent, Dir_ByDate) and len(parent.dateParts) != 2
+                ):
+                    return None
+                return Dir_Thumbs(path=path, environ=environ, parent=parent)
+            if i == len(paths) - 2:
+                res = self.get_resource_inst(parentPath + "/" + paths[-1], environ)
+                if not isinstance(res, onlineItem):
+                    return None
+                item = ItemRecord.fromApiObj(res.item)
+                fromLibrary = isinstance(res, onlineItemInAAlbum)
+                if item.getID() not in self.getThumbURLs([item], fromLibrary):
+                    return None
+                return onlineThumbnail(
+                    path=path, environ=environ, item=item, fromLibrary=fromLibrary
+                )
+            return None
+
         ########################################################
         #           /All
         ########################################################
@@ -651,7 +2214,44 @@ class baiduphoto(DAVProvider):
         if paths[0] == DirAllName and paths[1] != "":  # /All/filename.sufix
             fileName = paths[1]
             item = self.getItem_byNameWithCache(Name=fileName, paths=paths)
-            return onlineItem(path=path, environ=environ, item=item)
+            if item is None:
+                return None
+            return onlineItem(
+                path=path, environ=environ, item=item, listKey=("Item", "All")
+            )
+
+        ########################################################
+        #           /ByDate
+        #
+        # path = /ByDate
+        #      = /ByDate/year
+        #      = /ByDate/year/month
+        #      = /ByDate/year/month/fileName
+        ########################################################
+        if paths[0] == self.get_DateDirName():
+            dateParts = paths[1:]
+            if len(dateParts) > 3:
+                return None
+            if len(dateParts) == 0:
+                return Dir_ByDate(path=path, environ=environ, dateParts=dateParts)
+            months = self.syncDateTree()
+            if len(dateParts) == 1:
+                if dateParts[0] not in [m[:4] for m in months]:
+                    return None
+                return Dir_ByDate(path=path, environ=environ, dateParts=dateParts)
+            if "-".join(dateParts[:2]) not in months:
+                return None
+            if len(dateParts) == 2:
+                return Dir_ByDate(path=path, environ=environ, dateParts=dateParts)
+            item = self.getItem_byNameWithCache(Name=paths[-1], paths=paths)
+            if item is None or self.getMonthKey(item) != "-".join(dateParts[:2]):
+                return None
+            return onlineItem(
+                path=path,
+                environ=environ,
+                item=item,
+                listKey=("ByDate", "-".join(dateParts[:2])),
+            )
 
         ########################################################
         #           /AbstractAlbum